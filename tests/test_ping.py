@@ -0,0 +1,195 @@
+# SPDX-PackageSummary: Turku backups - storage module
+# SPDX-FileCopyrightText: Copyright (C) 2015-2020 Canonical Ltd.
+# SPDX-FileCopyrightText: Copyright (C) 2015-2021 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+import unittest
+import unittest.mock
+
+from turku_storage import ping
+
+
+@unittest.skipIf(os.name == "nt", "time.tzset not available")
+class TestStoragePing(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        config_d = os.path.join(self.tmpdir.name, "config.d")
+        os.mkdir(config_d)
+        self.config = {
+            "name": "test",
+            "secret": "secret",
+            "api_url": "https://example.com/",
+            "api_auth": "auth",
+            "log_file": "",
+            "lock_dir": self.tmpdir.name,
+            "var_dir": os.path.join(self.tmpdir.name, "var"),
+            "volumes": {"default": {"path": os.path.join(self.tmpdir.name, "vol")}},
+        }
+        os.mkdir(self.config["volumes"]["default"]["path"])
+        with open(os.path.join(config_d, "config.json"), "w") as f:
+            json.dump(self.config, f)
+        with unittest.mock.patch.dict(os.environ):
+            self.storage_ping = ping.StoragePing("uuid", config_dir=self.tmpdir.name)
+        self.addCleanup(self.remove_handlers)
+
+    def remove_handlers(self):
+        for handler in list(self.storage_ping.logger.handlers):
+            self.storage_ping.logger.removeHandler(handler)
+
+    def test_handlers_enabled_for(self):
+        # Ignore handlers on the root logger, e.g. pytest's log capture
+        self.storage_ping.logger.propagate = False
+        self.addCleanup(setattr, self.storage_ping.logger, "propagate", True)
+        # Only the console handler, at ERROR
+        self.assertFalse(self.storage_ping.handlers_enabled_for(logging.DEBUG))
+        self.assertTrue(self.storage_ping.handlers_enabled_for(logging.ERROR))
+        self.storage_ping.lh_console.setLevel(logging.INFO)
+        self.assertTrue(self.storage_ping.handlers_enabled_for(logging.INFO))
+
+    def test_run_logging_input(self):
+        returncode, output = self.storage_ping.run_logging(
+            ["sh", "-c", "cat; exit 3"], input="- excluded\n", output_lines=10
+        )
+        self.assertEqual(returncode, 3)
+        self.assertEqual(output, "- excluded\n")
+
+    def test_run_logging_large_input(self):
+        # Larger than the pipe buffers, so input must be written while
+        # output is being read
+        with unittest.mock.patch.object(self.storage_ping.logger, "propagate", False):
+            returncode, output = self.storage_ping.run_logging(
+                ["cat"], input="- x\n" * 100000, output_lines=2
+            )
+        self.assertEqual(returncode, 0)
+        self.assertEqual(output, "- x\n- x\n")
+
+    def test_run_logging_output_tail(self):
+        returncode, output = self.storage_ping.run_logging(
+            ["sh", "-c", "i=0; while [ $i -lt 100 ]; do i=$((i+1)); echo $i; done"],
+            output_lines=ping.OUTPUT_TAIL_LINES,
+        )
+        self.assertEqual(returncode, 0)
+        self.assertEqual(
+            output.splitlines(),
+            [str(i) for i in range(101 - ping.OUTPUT_TAIL_LINES, 101)],
+        )
+        self.assertEqual(self.storage_ping.run_logging(["sh", "-c", "echo x"]), (0, ""))
+
+    def test_run_logging_source_name(self):
+        with self.assertLogs(self.storage_ping.logger, logging.DEBUG) as logs:
+            self.storage_ping.run_logging(["sh", "-c", "echo file1"], source_name="a")
+        self.assertEqual(len(logs.output), 3)
+        for message in logs.output:
+            self.assertIn(":a: ", message)
+        self.assertTrue(logs.output[1].endswith(":a: file1"))
+
+    def test_process_ping_sources(self):
+        self.storage_ping.config["max_parallel_sources"] = 2
+        sources = {
+            name: {"username": "user", "password": "pass"} for name in ("a", "b", "c")
+        }
+        checkin_reply = {
+            "machine": {
+                "uuid": "uuid",
+                "unit_name": "machine",
+                "scheduled_sources": sources,
+            }
+        }
+
+        def run_logging(args, **kwargs):
+            if args[0] == "rsync" and args[-2].endswith("/b/"):
+                raise OSError("rsync failed")
+            return 0, ""
+
+        api_call_threads = []
+
+        def api_call(*args, **kwargs):
+            api_call_threads.append(threading.current_thread())
+            return checkin_reply
+
+        stdin = io.StringIO(json.dumps({"port": 12345}) + "\n.\n")
+        with unittest.mock.patch.object(
+            self.storage_ping, "run_logging", side_effect=run_logging
+        ), unittest.mock.patch.object(
+            ping, "api_call", side_effect=api_call
+        ) as mock_api_call, unittest.mock.patch.object(
+            ping.requests, "Session"
+        ) as mock_session, unittest.mock.patch.object(
+            self.storage_ping.logger, "exception"
+        ) as mock_exception, unittest.mock.patch(
+            "sys.stdin", stdin
+        ):
+            self.assertEqual(self.storage_ping.process_ping(), 1)
+
+        updated = set()
+        for call in mock_api_call.call_args_list:
+            if call[0][1] == "storage_ping_source_update":
+                updated.update(call[0][2]["machine"]["sources"])
+        self.assertEqual(updated, {"a", "c"})
+        self.assertEqual(set(api_call_threads), {threading.main_thread()})
+        mock_session.return_value.__exit__.assert_called_once()
+        mock_exception.assert_called_once()
+        self.assertIn('"b"', mock_exception.call_args[0][0])
+        for name in ("a", "c"):
+            snapshots = os.listdir(
+                os.path.join(
+                    self.config["volumes"]["default"]["path"],
+                    "uuid",
+                    "%s.snapshots" % name,
+                )
+            )
+            self.assertIn("latest", snapshots)
+
+    def test_process_ping_closes_session_on_error(self):
+        stdin = io.StringIO(json.dumps({"port": 12345}) + "\n.\n")
+        with unittest.mock.patch.object(
+            ping, "api_call", return_value={"machine": {}}
+        ), unittest.mock.patch.object(
+            ping.requests, "Session"
+        ) as mock_session, unittest.mock.patch(
+            "sys.stdin", stdin
+        ):
+            with self.assertRaises(KeyError):
+                self.storage_ping.process_ping()
+        mock_session.return_value.__exit__.assert_called_once()
+
+    def test_backup_source_retention_rm_failure(self):
+        machine_dir = os.path.join(self.config["volumes"]["default"]["path"], "uuid")
+        snapshot_dir = os.path.join(machine_dir, "a.snapshots")
+        os.makedirs(os.path.join(snapshot_dir, "2015-02-20T03:20:36"))
+        machine = {
+            "uuid": "uuid",
+            "unit_name": "machine",
+            "scheduled_sources": {
+                "a": {
+                    "username": "user",
+                    "password": "pass",
+                    "retention": "last 1 snapshots",
+                }
+            },
+        }
+
+        def run_logging(args, **kwargs):
+            return (1 if args[0] == "rm" else 0), ""
+
+        with unittest.mock.patch.object(
+            self.storage_ping, "run_logging", side_effect=run_logging
+        ), unittest.mock.patch.object(self.storage_ping.logger, "error") as mock_error:
+            status = self.storage_ping.backup_source(
+                {}, machine, machine_dir, 12345, "a"
+            )
+
+        self.assertTrue(status["success"])
+        self.assertIn(
+            "Failed to remove old snapshot: 2015-02-20T03:20:36 (rm exited 1)",
+            status["summary"],
+        )
+        self.assertNotIn("Removed old snapshot", status["summary"])
+        mock_error.assert_called_once()
@@ -3,6 +3,9 @@
 # SPDX-FileCopyrightText: Copyright (C) 2015-2021 Ryan Finnie <ryan@finnie.org>
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import json
+import os
+import tempfile
 import unittest
 import unittest.mock
 
@@ -17,3 +20,77 @@ class TestUtils(unittest.TestCase):
             }
             j = utils.api_call("https://example.com/", "cmd", {})
         self.assertIn("machine", j)
+
+    def test_api_call_session(self):
+        session = unittest.mock.Mock()
+        session.post.return_value.json.return_value = {"machine": {"sources": {}}}
+        j = utils.api_call("https://example.com/", "cmd", {}, session=session)
+        self.assertIn("machine", j)
+        session.post.assert_called_once()
+
+    @unittest.skipIf(os.name == "nt", "fcntl not available")
+    def test_acquire_lock(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            lock_name = os.path.join(tmpdir, "test.lock")
+            lock = utils.acquire_lock(lock_name)
+            with open(lock_name) as f:
+                self.assertEqual(int(f.read()), os.getpid())
+            with self.assertRaises(IOError):
+                utils.acquire_lock(lock_name)
+            lock.close()
+            self.assertFalse(os.path.exists(lock_name))
+
+    @unittest.skipIf(os.name == "nt", "symlinks not available")
+    def test_safe_symlink(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            link = os.path.join(tmpdir, "latest")
+            utils.safe_symlink("a", link)
+            self.assertEqual(os.readlink(link), "a")
+            utils.safe_symlink("b", link)
+            self.assertEqual(os.readlink(link), "b")
+            self.assertEqual(os.listdir(tmpdir), ["latest"])
+
+    @unittest.skipIf(os.name == "nt", "symlinks not available")
+    def test_list_subdirs(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.mkdir(os.path.join(tmpdir, "2015-02-20T03:20:36"))
+            open(os.path.join(tmpdir, "file"), "w").close()
+            os.symlink("2015-02-20T03:20:36", os.path.join(tmpdir, "latest"))
+            self.assertEqual(utils.list_subdirs(tmpdir), ["2015-02-20T03:20:36"])
+
+    def write_config(self, tmpdir, **kwargs):
+        config = {
+            "name": "test",
+            "secret": "secret",
+            "api_url": "https://example.com/",
+            "api_auth": "auth",
+            "volumes": {"default": {"path": tmpdir}},
+        }
+        config.update(kwargs)
+        os.makedirs(os.path.join(tmpdir, "config.d"), exist_ok=True)
+        with open(os.path.join(tmpdir, "config.d", "config.json"), "w") as f:
+            json.dump(config, f)
+
+    @unittest.skipIf(os.name == "nt", "time.tzset not available")
+    def test_load_config(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.write_config(tmpdir)
+            with unittest.mock.patch.dict(os.environ):
+                config = utils.load_config(tmpdir)
+        self.assertEqual(config["name"], "test")
+        self.assertEqual(config["timezone"], "UTC")
+        self.assertTrue(config["volumes"]["default"]["accept_new"])
+        self.assertEqual(config["max_parallel_sources"], 1)
+
+    @unittest.skipIf(os.name == "nt", "time.tzset not available")
+    def test_load_config_max_parallel_sources(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.write_config(tmpdir, max_parallel_sources="3")
+            with unittest.mock.patch.dict(os.environ):
+                config = utils.load_config(tmpdir)
+            self.assertEqual(config["max_parallel_sources"], 3)
+            for value in (0, "many", None):
+                self.write_config(tmpdir, max_parallel_sources=value)
+                with unittest.mock.patch.dict(os.environ):
+                    with self.assertRaises(Exception):
+                        utils.load_config(tmpdir)
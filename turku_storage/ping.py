@@ -3,17 +3,22 @@
 # SPDX-FileCopyrightText: Copyright (C) 2015-2021 Ryan Finnie <ryan@finnie.org>
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import collections
+import concurrent.futures
 import datetime
 import json
 import logging
 import logging.handlers
 import os
 import platform
+import stat
 import subprocess
 import sys
-import tempfile
+import threading
 import time
 
+import requests
+
 try:
     import systemd.journal as systemd_journal
 except ImportError as e:
@@ -26,8 +31,13 @@ from .utils import (
     random_weighted,
     get_latest_snapshot,
     get_snapshots_to_delete,
+    list_subdirs,
+    safe_symlink,
 )
 
+# Trailing lines of command output kept for source summaries
+OUTPUT_TAIL_LINES = 64
+
 
 class StoragePing:
     def __init__(self, uuid, config_dir="/etc/turku-storage"):
@@ -82,31 +92,298 @@ class StoragePing:
             self.lh_local.setLevel(logging.DEBUG)
             self.logger.addHandler(self.lh_local)
 
-    def run_logging(self, args, loglevel=logging.DEBUG, cwd=None, env=None):
-        self.logger.log(loglevel, "Running: %s" % repr(args))
+    def handlers_enabled_for(self, loglevel):
+        """Return whether any handler would emit a record at loglevel"""
+        if not self.logger.isEnabledFor(loglevel):
+            return False
+        logger = self.logger
+        while logger:
+            if any(loglevel >= h.level for h in logger.handlers):
+                return True
+            if not logger.propagate:
+                break
+            logger = logger.parent
+        return False
+
+    def run_logging(
+        self,
+        args,
+        loglevel=logging.DEBUG,
+        cwd=None,
+        env=None,
+        input=None,
+        output_lines=0,
+        source_name=None,
+    ):
+        """Run a command, logging its output
+
+        Log lines are prefixed with source_name if given, as sources may
+        run concurrently.  Returns the return code and the last
+        output_lines lines of output.
+        """
+        prefix = "%s: " % source_name if source_name else ""
+        self.logger.log(loglevel, "%sRunning: %s" % (prefix, repr(args)))
         with subprocess.Popen(
             args,
             cwd=cwd,
             env=env,
             encoding="UTF-8",
+            stdin=(None if input is None else subprocess.PIPE),
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
         ) as proc:
+            # Feed input from another thread, as the child may not consume
+            # all of it before its output needs to be drained
+            input_thread = None
+            if input is not None:
+
+                def write_input():
+                    try:
+                        with proc.stdin as stdin:
+                            stdin.write(input)
+                    except BrokenPipeError:
+                        pass
+
+                input_thread = threading.Thread(target=write_input)
+                input_thread.start()
+            # Output must be drained regardless, but skip formatting
+            # lines no handler will emit
+            log_output = self.handlers_enabled_for(loglevel)
+            output = collections.deque(maxlen=output_lines) if output_lines else None
             with proc.stdout as stdout:
                 for line in iter(stdout.readline, ""):
-                    self.logger.log(loglevel, line.rstrip())
-        self.logger.log(loglevel, "Return code: %d" % proc.returncode)
-        return proc.returncode
+                    if log_output:
+                        self.logger.log(loglevel, prefix + line.rstrip())
+                    if output is not None:
+                        output.append(line)
+            if input_thread is not None:
+                input_thread.join()
+        self.logger.log(loglevel, "%sReturn code: %d" % (prefix, proc.returncode))
+        return proc.returncode, ("".join(output) if output is not None else "")
+
+    def get_volume_weights(self):
+        """Return available space of volumes accepting new machines"""
+        weights = {}
+        for volume_name in self.config["volumes"]:
+            v = self.config["volumes"][volume_name]
+            try:
+                sv = os.statvfs(v["path"])
+            except OSError:
+                continue
+            s_t = sv.f_bsize * sv.f_blocks / 1048576
+            s_a = sv.f_bsize * sv.f_bavail / 1048576
+            pct_used = (1.0 - float(s_a) / float(s_t)) * 100.0
+            if (not v["accept_new"]) or (pct_used > v["accept_new_high_water_pct"]):
+                continue
+            weights[volume_name] = s_a
+        return weights
+
+    def prepare_machine_dir(self, machine):
+        var_machines = os.path.join(self.config["var_dir"], "machines")
+        os.makedirs(var_machines, exist_ok=True)
+
+        machine_uuid_path = os.path.join(var_machines, machine["uuid"])
+        try:
+            machine_uuid_st = os.lstat(machine_uuid_path)
+        except FileNotFoundError:
+            machine_uuid_st = None
+        if machine_uuid_st is not None and stat.S_ISLNK(machine_uuid_st.st_mode):
+            machine_dir = os.readlink(machine_uuid_path)
+            # Normally already exists, so check before trying to create it
+            need_mkdir = not os.path.isdir(machine_dir)
+        else:
+            weights = self.get_volume_weights()
+            if len(weights) == 0:
+                raise Exception("Cannot find a suitable storage directory")
+            chosen_volume = random_weighted(weights)
+            if not chosen_volume:
+                raise Exception("Cannot find a suitable storage directory")
+            machine_dir = os.path.join(
+                self.config["volumes"][chosen_volume]["path"], machine["uuid"]
+            )
+            os.symlink(machine_dir, machine_uuid_path)
+            need_mkdir = True
+        if need_mkdir:
+            os.makedirs(machine_dir, exist_ok=True)
+
+        machine_symlink = machine["unit_name"]
+        if machine.get("service_name"):
+            machine_symlink = machine["service_name"] + "-" + machine_symlink
+        if machine.get("environment_name"):
+            machine_symlink = machine["environment_name"] + "-" + machine_symlink
+        machine_symlink = machine_symlink.replace("/", "_")
+        machine_symlink_path = os.path.join(var_machines, machine_symlink)
+        try:
+            machine_symlink_st = os.lstat(machine_symlink_path)
+        except FileNotFoundError:
+            machine_symlink_st = None
+        if machine_symlink_st is None or stat.S_ISLNK(machine_symlink_st.st_mode):
+            safe_symlink(machine["uuid"], machine_symlink_path)
+
+        return machine_dir
+
+    def backup_source(self, j, machine, machine_dir, forwarded_port, source_name):
+        """Back up a source, returning its status for the API"""
+        time_begin = time.time()
+        s = machine["scheduled_sources"][source_name]
+        if source_name in j.get("sources", {}):
+            source_auth = j["sources"][source_name]
+        else:
+            source_auth = s
+        source_username = source_auth.get("username")
+        source_password = source_auth.get("password")
+        if not (source_username and source_password):
+            self.logger.error(
+                'Cannot find authentication for source "%s"' % source_name
+            )
+            return
+        snapshot_mode = self.config["snapshot_mode"]
+        if snapshot_mode == "link-dest":
+            if s.get("large_rotating_files"):
+                snapshot_mode = "none"
+            if s.get("large_modifying_files"):
+                snapshot_mode = "none"
+        if s.get("snapshot_mode"):
+            snapshot_mode = s["snapshot_mode"]
+
+        self.logger.info("Begin: %s %s" % (machine["unit_name"], source_name))
+
+        rsync_args = [
+            "rsync",
+            "--archive",
+            "--compress",
+            "--numeric-ids",
+            "--delete",
+            "--delete-excluded",
+            "--stats",
+        ]
+        if j.get("verbose"):
+            rsync_args.append("--verbose")
+
+        dest_dir = os.path.join(machine_dir, source_name)
+        os.makedirs(dest_dir, exist_ok=True)
+        if snapshot_mode == "link-dest":
+            snapshot_dir = os.path.join(machine_dir, "%s.snapshots" % source_name)
+            os.makedirs(snapshot_dir, exist_ok=True)
+            dirs = list_subdirs(snapshot_dir)
+            base_snapshot = get_latest_snapshot(dirs)
+            if base_snapshot:
+                rsync_args.append(
+                    "--link-dest=%s" % os.path.join(snapshot_dir, base_snapshot)
+                )
+                # repeat the option so that rsync looks into the dir specified in link-dest, see rsync(1)
+                rsync_args.extend(["--fuzzy", "--fuzzy"])
+        else:
+            rsync_args.append("--inplace")
+        if self.config["preserve_hard_links"]:
+            rsync_args.append("--hard-links")
+
+        filter_lines = []
+        if "filter" in s:
+            for filter in s["filter"]:
+                if filter.startswith("merge") or filter.startswith(":"):
+                    # Do not allow local merges
+                    continue
+                filter_lines.append("%s\n" % filter)
+        if "exclude" in s:
+            for exclude in s["exclude"]:
+                filter_lines.append("- %s\n" % exclude)
+        filter_data = "".join(filter_lines)
+        if filter_data:
+            # Filter rules are fed to rsync on stdin
+            rsync_args.append("--filter=merge -")
+
+        if s.get("bwlimit"):
+            rsync_args.append("--bwlimit=%s" % s["bwlimit"])
+
+        rsync_args.append(
+            "rsync://%s@127.0.0.1:%d/%s/"
+            % (source_username, forwarded_port, source_name)
+        )
+
+        rsync_args.append("%s/" % dest_dir)
+
+        rsync_env = {"RSYNC_PASSWORD": source_password}
+        returncode, rsync_output = self.run_logging(
+            rsync_args,
+            env=rsync_env,
+            input=(filter_data or None),
+            output_lines=OUTPUT_TAIL_LINES,
+            source_name=source_name,
+        )
+        if returncode in (0, 24):
+            success = True
+        else:
+            success = False
+
+        snapshot_name = None
+        summary_output = rsync_output
+        if success:
+            if snapshot_mode == "link-dest":
+                if base_snapshot:
+                    summary_output = (
+                        "Base snapshot: %s\n" % base_snapshot + summary_output
+                    )
+                snapshot_name = datetime.datetime.now().isoformat()
+                os.rename(dest_dir, os.path.join(snapshot_dir, snapshot_name))
+                latest_path = os.path.join(snapshot_dir, "latest")
+                try:
+                    latest_st = os.lstat(latest_path)
+                except FileNotFoundError:
+                    latest_st = None
+                if latest_st is None or stat.S_ISLNK(latest_st.st_mode):
+                    safe_symlink(snapshot_name, latest_path)
+                if "retention" in s:
+                    dirs = list_subdirs(snapshot_dir)
+                    to_delete = get_snapshots_to_delete(s["retention"], dirs)
+                    for snapshot in to_delete:
+                        temp_delete_tree = os.path.join(
+                            snapshot_dir, "_delete-%s" % snapshot
+                        )
+                        os.rename(
+                            os.path.join(snapshot_dir, snapshot), temp_delete_tree
+                        )
+                        rm_returncode, _ = self.run_logging(
+                            ["rm", "-rf", temp_delete_tree], source_name=source_name
+                        )
+                        if rm_returncode == 0:
+                            summary_output = (
+                                summary_output + "Removed old snapshot: %s\n" % snapshot
+                            )
+                        else:
+                            self.logger.error(
+                                "%s: Failed to remove %s (rm exited %d)"
+                                % (source_name, temp_delete_tree, rm_returncode)
+                            )
+                            summary_output = (
+                                summary_output
+                                + "Failed to remove old snapshot: %s (rm exited %d)\n"
+                                % (snapshot, rm_returncode)
+                            )
+        else:
+            summary_output = (
+                "rsync exited with return code %d\n" % returncode + summary_output
+            )
+
+        time_end = time.time()
+        return {
+            "success": success,
+            "snapshot": snapshot_name,
+            "summary": summary_output,
+            "time_begin": time_begin,
+            "time_end": time_end,
+        }
 
     def process_ping(self):
-        jsonin = ""
-        while True:
-            line = sys.stdin.readline()
-            if (not line) or (line.rstrip() == "."):
+        # Input is terminated by a "." line or EOF; the agent keeps stdin
+        # open afterward, so it cannot simply be read to completion.
+        lines = []
+        for line in iter(sys.stdin.readline, ""):
+            if line.rstrip() == ".":
                 break
-            jsonin = jsonin + line
+            lines.append(line)
         try:
-            j = json.loads(jsonin)
+            j = json.loads("".join(lines))
         except ValueError:
             raise Exception("Invalid input JSON")
 
@@ -120,13 +397,11 @@ class StoragePing:
             raise Exception("Port required")
         forwarded_port = int(j["port"])
 
-        verbose = False
-        if "verbose" in j and j["verbose"]:
-            verbose = True
+        verbose = bool(j.get("verbose"))
         if verbose:
             self.lh_console.setLevel(logging.INFO)
 
-        if "action" in j and j["action"] == "restore":
+        if j.get("action") == "restore":
             self.logger.info(
                 "Restore mode active on port %d.  Good luck." % forwarded_port
             )
@@ -137,230 +412,75 @@ class StoragePing:
             "storage": {"name": self.config["name"], "secret": self.config["secret"]},
             "machine": {"uuid": self.arg_uuid},
         }
-        api_reply = api_call(self.config["api_url"], "storage_ping_checkin", api_out)
-
-        machine = api_reply["machine"]
-        scheduled_sources = machine["scheduled_sources"]
-        if len(scheduled_sources) > 0:
-            self.logger.info(
-                "Sources to back up: %s" % ", ".join([s for s in scheduled_sources])
-            )
-        else:
-            self.logger.info("No sources to back up now")
-        for source_name in scheduled_sources:
-            time_begin = time.time()
-            s = scheduled_sources[source_name]
-            source_username = None
-            source_password = None
-            if ("sources" in j) and (source_name in j["sources"]):
-                if ("username" in j["sources"][source_name]) and j["sources"][
-                    source_name
-                ]["username"]:
-                    source_username = j["sources"][source_name]["username"]
-                if ("password" in j["sources"][source_name]) and j["sources"][
-                    source_name
-                ]["password"]:
-                    source_password = j["sources"][source_name]["password"]
-            else:
-                if ("username" in s) and s["username"]:
-                    source_username = s["username"]
-                if ("password" in s) and s["password"]:
-                    source_password = s["password"]
-            if not (source_username and source_password):
-                self.logger.error(
-                    'Cannot find authentication for source "%s"' % source_name
-                )
-                continue
-            snapshot_mode = self.config["snapshot_mode"]
-            if snapshot_mode == "link-dest":
-                if "large_rotating_files" in s and s["large_rotating_files"]:
-                    snapshot_mode = "none"
-                if "large_modifying_files" in s and s["large_modifying_files"]:
-                    snapshot_mode = "none"
-            if "snapshot_mode" in s and s["snapshot_mode"]:
-                snapshot_mode = s["snapshot_mode"]
-
-            var_machines = os.path.join(self.config["var_dir"], "machines")
-            if not os.path.exists(var_machines):
-                os.makedirs(var_machines)
-
-            if os.path.islink(os.path.join(var_machines, machine["uuid"])):
-                machine_dir = os.readlink(os.path.join(var_machines, machine["uuid"]))
-            else:
-                weights = {}
-                for volume_name in self.config["volumes"]:
-                    v = self.config["volumes"][volume_name]
-                    try:
-                        sv = os.statvfs(v["path"])
-                    except OSError:
-                        continue
-                    s_t = sv.f_bsize * sv.f_blocks / 1048576
-                    s_a = sv.f_bsize * sv.f_bavail / 1048576
-                    pct_used = (1.0 - float(s_a) / float(s_t)) * 100.0
-                    if (not v["accept_new"]) or (
-                        pct_used > v["accept_new_high_water_pct"]
-                    ):
-                        continue
-                    weights[volume_name] = s_a
-                if len(weights) == 0:
-                    raise Exception("Cannot find a suitable storage directory")
-                chosen_volume = random_weighted(weights)
-                if not chosen_volume:
-                    raise Exception("Cannot find a suitable storage directory")
-                machine_dir = os.path.join(
-                    self.config["volumes"][chosen_volume]["path"], machine["uuid"]
-                )
-                os.symlink(machine_dir, os.path.join(var_machines, machine["uuid"]))
-            if not os.path.exists(machine_dir):
-                os.makedirs(machine_dir)
-
-            machine_symlink = machine["unit_name"]
-            if "service_name" in machine and machine["service_name"]:
-                machine_symlink = machine["service_name"] + "-" + machine_symlink
-            if "environment_name" in machine and machine["environment_name"]:
-                machine_symlink = machine["environment_name"] + "-" + machine_symlink
-            machine_symlink = machine_symlink.replace("/", "_")
-            if os.path.islink(os.path.join(var_machines, machine_symlink)):
-                os.unlink(os.path.join(var_machines, machine_symlink))
-            if not os.path.exists(os.path.join(var_machines, machine_symlink)):
-                os.symlink(machine["uuid"], os.path.join(var_machines, machine_symlink))
-
-            self.logger.info("Begin: %s %s" % (machine["unit_name"], source_name))
-
-            rsync_args = [
-                "rsync",
-                "--archive",
-                "--compress",
-                "--numeric-ids",
-                "--delete",
-                "--delete-excluded",
-            ]
-            rsync_args.append("--verbose")
-
-            dest_dir = os.path.join(machine_dir, source_name)
-            if not os.path.exists(dest_dir):
-                os.makedirs(dest_dir)
-            if snapshot_mode == "link-dest":
-                snapshot_dir = os.path.join(machine_dir, "%s.snapshots" % source_name)
-                if not os.path.exists(snapshot_dir):
-                    os.makedirs(snapshot_dir)
-                dirs = [
-                    d
-                    for d in os.listdir(snapshot_dir)
-                    if os.path.isdir(os.path.join(snapshot_dir, d))
-                ]
-                base_snapshot = get_latest_snapshot(dirs)
-                if base_snapshot:
-                    rsync_args.append(
-                        "--link-dest=%s" % os.path.join(snapshot_dir, base_snapshot)
-                    )
-                    # repeat the option so that rsync looks into the dir specified in link-dest, see rsync(1)
-                    rsync_args.extend(["--fuzzy", "--fuzzy"])
-            else:
-                rsync_args.append("--inplace")
-            if self.config["preserve_hard_links"]:
-                rsync_args.append("--hard-links")
-
-            filter_file = None
-            filter_data = ""
-            if "filter" in s:
-                for filter in s["filter"]:
-                    if filter.startswith("merge") or filter.startswith(":"):
-                        # Do not allow local merges
-                        continue
-                    filter_data += "%s\n" % filter
-            if "exclude" in s:
-                for exclude in s["exclude"]:
-                    filter_data += "- %s\n" % exclude
-            if filter_data:
-                filter_file = tempfile.NamedTemporaryFile(mode="w+", encoding="UTF-8")
-                filter_file.write(filter_data)
-                filter_file.flush()
-                rsync_args.append("--filter=merge %s" % filter_file.name)
-
-            if "bwlimit" in s and s["bwlimit"]:
-                rsync_args.append("--bwlimit=%s" % s["bwlimit"])
-
-            rsync_args.append(
-                "rsync://%s@127.0.0.1:%d/%s/"
-                % (source_username, forwarded_port, source_name)
+        with requests.Session() as api_session:
+            api_reply = api_call(
+                self.config["api_url"],
+                "storage_ping_checkin",
+                api_out,
+                session=api_session,
             )
 
-            rsync_args.append("%s/" % dest_dir)
-
-            rsync_env = {"RSYNC_PASSWORD": source_password}
-            returncode = self.run_logging(rsync_args, env=rsync_env)
-            if returncode in (0, 24):
-                success = True
-            else:
-                success = False
-            if filter_file:
-                filter_file.close()
-
-            snapshot_name = None
-            summary_output = None
-            if success:
-                if snapshot_mode == "link-dest":
-                    summary_output = ""
-                    if base_snapshot:
-                        summary_output = (
-                            summary_output + "Base snapshot: %s\n" % base_snapshot
-                        )
-                    snapshot_name = datetime.datetime.now().isoformat()
-                    os.rename(dest_dir, os.path.join(snapshot_dir, snapshot_name))
-                    if os.path.islink(os.path.join(snapshot_dir, "latest")):
-                        os.unlink(os.path.join(snapshot_dir, "latest"))
-                    if not os.path.exists(os.path.join(snapshot_dir, "latest")):
-                        os.symlink(snapshot_name, os.path.join(snapshot_dir, "latest"))
-                    if "retention" in s:
-                        dirs = [
-                            d
-                            for d in os.listdir(snapshot_dir)
-                            if os.path.isdir(os.path.join(snapshot_dir, d))
-                        ]
-                        to_delete = get_snapshots_to_delete(s["retention"], dirs)
-                        for snapshot in to_delete:
-                            temp_delete_tree = os.path.join(
-                                snapshot_dir, "_delete-%s" % snapshot
-                            )
-                            os.rename(
-                                os.path.join(snapshot_dir, snapshot), temp_delete_tree
+            machine = api_reply["machine"]
+            scheduled_sources = machine["scheduled_sources"]
+            failed = False
+            if len(scheduled_sources) > 0:
+                self.logger.info(
+                    "Sources to back up: %s" % ", ".join([s for s in scheduled_sources])
+                )
+                machine_dir = self.prepare_machine_dir(machine)
+                with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.config["max_parallel_sources"]
+                ) as executor:
+                    futures = {
+                        executor.submit(
+                            self.backup_source,
+                            j,
+                            machine,
+                            machine_dir,
+                            forwarded_port,
+                            source_name,
+                        ): source_name
+                        for source_name in scheduled_sources
+                    }
+                    # Status updates are sent from this thread only, as the
+                    # requests session is not thread-safe
+                    for future in concurrent.futures.as_completed(futures):
+                        source_name = futures[future]
+                        try:
+                            source_status = future.result()
+                            if source_status is None:
+                                continue
+                            api_out = {
+                                "storage": {
+                                    "name": self.config["name"],
+                                    "secret": self.config["secret"],
+                                },
+                                "machine": {
+                                    "uuid": self.arg_uuid,
+                                    "sources": {source_name: source_status},
+                                },
+                            }
+                            api_call(
+                                self.config["api_url"],
+                                "storage_ping_source_update",
+                                api_out,
+                                session=api_session,
                             )
-                            # Should better handle this
-                            subprocess.call(["rm", "-rf", temp_delete_tree])
-                            summary_output = (
-                                summary_output + "Removed old snapshot: %s\n" % snapshot
+                        except Exception:
+                            self.logger.exception(
+                                'Backup of source "%s" failed' % source_name
                             )
+                            failed = True
+                            continue
+                        self.logger.info(
+                            "End: %s %s" % (machine["unit_name"], source_name)
+                        )
             else:
-                summary_output = "rsync exited with return code %d" % returncode
-
-            time_end = time.time()
-            api_out = {
-                "storage": {
-                    "name": self.config["name"],
-                    "secret": self.config["secret"],
-                },
-                "machine": {
-                    "uuid": self.arg_uuid,
-                    "sources": {
-                        source_name: {
-                            "success": success,
-                            "snapshot": snapshot_name,
-                            "summary": summary_output,
-                            "time_begin": time_begin,
-                            "time_end": time_end,
-                        }
-                    },
-                },
-            }
-            api_reply = api_call(
-                self.config["api_url"], "storage_ping_source_update", api_out
-            )
-
-            self.logger.info("End: %s %s" % (machine["unit_name"], source_name))
-
+                self.logger.info("No sources to back up now")
         self.logger.info("Done")
         lock.close()
+        if failed:
+            return 1
 
     def main(self):
         try:
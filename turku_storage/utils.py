@@ -27,6 +27,10 @@ try:
 except ImportError as e:
     yaml = e
 
+RETENTION_EARLIEST_RE = re.compile(r"^earliest of (?:(\d+) )?(day|week|month)")
+RETENTION_LAST_DAYS_RE = re.compile(r"^last (\d+) day")
+RETENTION_LAST_SNAPSHOTS_RE = re.compile(r"^last (\d+) snapshot")
+
 
 class RuntimeLock:
     name = None
@@ -35,14 +39,18 @@ class RuntimeLock:
     def __init__(self, name):
         import fcntl
 
-        file = open(name, "w")
+        # Do not truncate until the lock is held, as another process may own it
+        fd = os.open(name, os.O_CREAT | os.O_RDWR | os.O_CLOEXEC, 0o644)
+        file = open(fd, "w")
         try:
-            fcntl.lockf(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
         except IOError as e:
             import errno
 
             if e.errno in (errno.EACCES, errno.EAGAIN):
+                file.close()
                 raise
+        file.truncate()
         file.write("%10s\n" % os.getpid())
         file.flush()
         file.seek(0)
@@ -116,11 +124,24 @@ def safe_write(file, **kwargs):
     return fh
 
 
-def api_call(api_url, cmd, post_data, timeout=5):
+def safe_symlink(src, dst):
+    """Atomically create or replace a symlink"""
+    temp_name = "{}.tmp{}~".format(dst, str(uuid.uuid4()))
+    os.symlink(src, temp_name)
+    try:
+        os.rename(temp_name, dst)
+    except OSError:
+        os.unlink(temp_name)
+        raise
+
+
+def api_call(api_url, cmd, post_data, timeout=5, session=None):
     """Turku API call client"""
     url = urllib.parse.urljoin(api_url + "/", cmd)
     headers = {"Accept": "application/json"}
-    r = requests.post(url, json=post_data, headers=headers, timeout=timeout)
+    if session is None:
+        session = requests
+    r = session.post(url, json=post_data, headers=headers, timeout=timeout)
     r.raise_for_status()
     return r.json()
 
@@ -200,6 +221,14 @@ def load_config(config_dir):
         config["snapshot_mode"] = "link-dest"
     if "preserve_hard_links" not in config:
         config["preserve_hard_links"] = False
+    if "max_parallel_sources" not in config:
+        config["max_parallel_sources"] = 1
+    try:
+        config["max_parallel_sources"] = int(config["max_parallel_sources"])
+    except (TypeError, ValueError):
+        raise Exception("Invalid max_parallel_sources")
+    if config["max_parallel_sources"] < 1:
+        raise Exception("Invalid max_parallel_sources")
 
     if "ssh_ping_host" not in config:
         config["ssh_ping_host"] = socket.getfqdn()
@@ -258,6 +287,12 @@ def parse_snapshot_name(ss):
     raise ValueError("Unknown snapshot name format")
 
 
+def list_subdirs(path):
+    """Return the names of directories (not symlinks) directly under path"""
+    with os.scandir(path) as it:
+        return [e.name for e in it if e.is_dir(follow_symlinks=False)]
+
+
 def get_latest_snapshot(snapshots):
     snapshot_dict = {}
     for ss in snapshots:
@@ -282,7 +317,7 @@ def get_snapshots_to_delete(retention, snapshots):
     to_keep = []
     for ritem in retention.split(","):
         ritem = ritem.strip()
-        r = re.findall(r"^earliest of (?:(\d+) )?(day|week|month)", ritem)
+        r = RETENTION_EARLIEST_RE.findall(ritem)
         if len(r) > 0:
             if r[0][0] == "":
                 earliest_num = 1
@@ -328,7 +363,7 @@ def get_snapshots_to_delete(retention, snapshots):
                 candidate_s = s
             if candidate_s and candidate_s not in to_keep:
                 to_keep.append(candidate_s)
-        r = re.findall(r"^last (\d+) day", ritem)
+        r = RETENTION_LAST_DAYS_RE.findall(ritem)
         if len(r) > 0:
             last_days = int(r[0])
             cutoff_time = now - datetime.timedelta(days=last_days)
@@ -337,7 +372,7 @@ def get_snapshots_to_delete(retention, snapshots):
                     continue
                 if s not in to_keep:
                     to_keep.append(s)
-        r = re.findall(r"^last (\d+) snapshot", ritem)
+        r = RETENTION_LAST_SNAPSHOTS_RE.findall(ritem)
         if len(r) > 0:
             last_snapshots = int(r[0])
             i = 0